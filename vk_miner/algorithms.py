@@ -7,7 +7,6 @@ __author__ = 'Artur Chakhvadze (norpadon@yandex.ru)'
 from itertools import *
 from functools import *
 
-import pandas as pd
 from tornado import gen
 
 from vk_async.exceptions import VkAPIMethodError
@@ -15,7 +14,8 @@ from vk_miner.community import Community
 from vk_miner.utils import *
 
 
-def load_friends_bfs(api, roots, depth, preloaded=None):
+def load_friends_bfs(api, roots, depth, preloaded=None, writer=None,
+                     profiler=None):
     """Load graph of friends via breadth-first-search.
 
     Args:
@@ -23,6 +23,13 @@ def load_friends_bfs(api, roots, depth, preloaded=None):
         roots: list of users, whose friends we need to load.
         depth: maximal distance between root and loaded user.
         preloaded: preloaded data that should be appended to result.
+        writer: optional community.CommunityWriter, users are written to it
+            as soon as their friends are loaded, side tables are written
+            after each layer (cities without coordinates until the end).
+        profiler: optional utils.CrawlProfiler. If provided, time of each
+            phase and RSS after each layer are stored in it, as well as
+            memory usage of the resulting community if profiler measures
+            memory. Time of 'fetch' includes 'parse'.
 
     Returns:
         Community object with loaded data.
@@ -35,6 +42,10 @@ def load_friends_bfs(api, roots, depth, preloaded=None):
     if not preloaded:
         preloaded = [{} for _ in range(6)]
 
+    profile = profiler is not None
+    if not profile:
+        profiler = NullProfiler()
+
     cities, universities, groups, users, friends, subscriptions = preloaded
     members = {}
 
@@ -51,7 +62,7 @@ def load_friends_bfs(api, roots, depth, preloaded=None):
             for item in chain(*result)
         ]
 
-    def load_friends(user_ids):
+    def load_friends(user_ids, section):
         """Load friends of users with given ids."""
         counter = 0
 
@@ -89,7 +100,8 @@ def load_friends_bfs(api, roots, depth, preloaded=None):
             try:
                 result = yield api.execute.getUserData(user_id=uid)
                 log_user_loaded()
-                return parse_item(result)
+                with profiler.timer(section, 'parse'):
+                    return parse_item(result)
             except (VkAPIMethodError, KeyError) as e:
                 print(e)
                 return {}
@@ -98,8 +110,11 @@ def load_friends_bfs(api, roots, depth, preloaded=None):
 
     print('Loading roots...', flush=True)
     visited = set()
-    not_visited = set(load_users(roots))
+    with profiler.timer('roots', 'fetch'):
+        not_visited = set(load_users(roots))
     layers = {u: 0 for u in not_visited}
+    profiler.add('roots', 'users', len(not_visited))
+    profiler.sample_rss('roots')
 
     for i in range(1, depth + 1):
         print(
@@ -107,31 +122,54 @@ def load_friends_bfs(api, roots, depth, preloaded=None):
             flush=True
         )
 
+        section = 'layer {}'.format(i)
         queue = list(not_visited)
-        chunk = load_friends(queue)
-        new_layer = set()
-        for j, user_data in enumerate(chunk):
-            uid = queue[j]
-            friends[uid], subscriptions[uid] = user_data
-
-            for group_id in subscriptions[uid]:
-                if group_id not in members:
-                    members[group_id] = []
-                members[group_id].append(uid)
-
-            new_layer.update(friends[uid])
-
-        visited.update(not_visited)
-        new_layer -= visited
-        not_visited = new_layer
-        for u in new_layer:
-            layers[u] = i
+        with profiler.timer(section, 'fetch'):
+            chunk = load_friends(queue, section)
+
+        with profiler.timer(section, 'tables'):
+            new_layer = set()
+            for j, user_data in enumerate(chunk):
+                uid = queue[j]
+                friends[uid], subscriptions[uid] = user_data
+
+                for group_id in subscriptions[uid]:
+                    if group_id not in members:
+                        members[group_id] = []
+                    members[group_id].append(uid)
+
+                new_layer.update(friends[uid])
+
+                if writer:
+                    writer.write_user(
+                        uid, users[uid], {'layer': layers[uid]},
+                        friends[uid], subscriptions[uid],
+                    )
+
+            visited.update(not_visited)
+            new_layer -= visited
+            not_visited = new_layer
+            for u in new_layer:
+                layers[u] = i
+
+            if writer:
+                writer.write_tables(
+                    groups, {},
+                    {c: [name, None, None] for c, name in cities.items()},
+                    universities,
+                )
+
+        profiler.add(section, 'users', len(queue))
+        profiler.add(section, 'new_users', len(new_layer))
+        profiler.sample_rss(section)
 
     # Load geographical data.
     print('Loading geodata...', flush=True)
 
-    for c in cities:
-        cities[c] = load_city(cities[c])
+    with profiler.timer('geodata', 'fetch'):
+        for c in cities:
+            cities[c] = load_city(cities[c])
+    profiler.add('geodata', 'cities', len(cities))
 
     print('Done!', flush=True)
 
@@ -142,8 +180,16 @@ def load_friends_bfs(api, roots, depth, preloaded=None):
             friends[user_id] = []
         if user_id not in subscriptions:
             subscriptions[user_id] = []
+        if writer and user_id not in visited:
+            writer.write_user(
+                user_id, users[user_id], user_attributes.get(user_id, {}),
+                friends[user_id], subscriptions[user_id],
+            )
+
+    if writer:
+        writer.write_tables(groups, {}, cities, universities)
 
-    return Community(
+    result = Community(
             users=users,
             groups=groups,
             members=members,
@@ -155,6 +201,11 @@ def load_friends_bfs(api, roots, depth, preloaded=None):
             universities=universities,
         )
 
+    if profile and profiler.measure_memory:
+        profiler.memory_usage = result.memory_usage()
+
+    return result
+
 
 def load_group_members(api, group_id):
     """Load graph of group members.
@@ -4,17 +4,24 @@
 
 __author__ = 'Artur Chakhvadze (norpadon@yandex.ru)'
 
+import os
 from functools import *
-from collections import Counter
-from json import load, dump
+from itertools import chain
+from glob import glob
+from numbers import Number
+from json import load, loads, dump, dumps
 
-import pandas as pd
-import numpy as np
-import networkx as nx
-import mplleaflet
-from matplotlib import pyplot as plt
+from vk_miner.utils import User, deep_getsizeof
 
-from vk_miner.utils import User
+USERS_SHARD = 'users-{:05d}.jsonl'
+USERS_SHARD_PATTERN = 'users-*.jsonl'
+TABLES_FILE = 'tables.json'
+
+
+def _user_field(name):
+    """Make property for field of users table with given name."""
+    index = User._fields.index(name)
+    return property(lambda self: self.owner._users[self.uid][index])
 
 
 class Community(object):
@@ -23,8 +30,16 @@ class Community(object):
     """
     class User(object):
         """Wrapper around entry in users table."""
+        __slots__ = ('owner', 'uid')
+
         def __init__(self, owner, uid):
-            self.__dict__['owner'], self.__dict__['uid'] = owner, uid
+            self.owner, self.uid = owner, uid
+
+        name = _user_field('name')
+        age = _user_field('age')
+        city_id = _user_field('city_id')
+        university_id = _user_field('university_id')
+        last_seen = _user_field('last_seen')
             
         @property
         def friends(self):
@@ -54,6 +69,8 @@ class Community(object):
             Returns:
                 networkx.Graph object.
             """
+            import networkx as nx
+
             neighbours = set(self.friends)
             result = nx.Graph()
             result.add_nodes_from(neighbours)
@@ -65,10 +82,9 @@ class Community(object):
             return result
         
         def __getattr__(self, name):
-            if name in User._fields:
-                return getattr(self.owner._users[self.uid], name)
-            else:
-                return self.owner._user_attributes[self.uid][name]
+            if name in Community.User.__slots__:
+                raise AttributeError(name)
+            return self.owner._user_attributes[self.uid][name]
 
         def __eq__(self, other):
             return all([
@@ -96,8 +112,10 @@ class Community(object):
             
     class Group(object):
         """Wrapper around entry in communities table."""
+        __slots__ = ('owner', 'uid')
+
         def __init__(self, owner, uid):
-            self.__dict__['owner'], self.__dict__['uid'] = owner, uid
+            self.owner, self.uid = owner, uid
 
         @property
         def name(self):
@@ -108,6 +126,8 @@ class Community(object):
             return self.owner._members[self.uid]
 
         def __getattr__(self, name):
+            if name in Community.Group.__slots__:
+                raise AttributeError(name)
             return self.owner._group_attributes[self.uid][name]
 
         def __eq__(self, other):
@@ -141,7 +161,7 @@ class Community(object):
         Create empty community otherwise.
 
         Args:
-            path: path to the json file or folder with csv files
+            path: path to the json file or folder with json lines files
                 containing community data.
             **kwargs: values of tables.
         """
@@ -151,7 +171,9 @@ class Community(object):
             '_user_attributes', '_group_attributes',
         ]
 
-        if path:
+        if path and os.path.isdir(path):
+            data = _load_jsonl(path, processes=1)
+        elif path:
             data = load(open(path))
         else:
             data = {}
@@ -176,6 +198,76 @@ class Community(object):
         data = {field: self.__dict__[field] for field in self.fields}
         dump(data, open(path, 'w'), indent=2, ensure_ascii=False)
 
+    @classmethod
+    def load_jsonl(cls, path, predicate=None, processes=None):
+        """Load community from folder in sharded JSON lines format.
+
+        Args:
+            path: path to the folder.
+            predicate: function from user record to boolean.
+                Only users satisfying it are kept.
+                Must be picklable if shards are loaded in parallel.
+            processes: number of processes to load shards with,
+                number of CPUs by default, never more than number of shards.
+                Shards are loaded in the current process if it is 1.
+                Parallel loading on platforms that spawn processes
+                (macOS, Windows) requires `if __name__ == '__main__'` guard.
+
+        Returns:
+            Community object.
+        """
+        data = _load_jsonl(path, predicate, processes)
+        return cls(**{field[1:]: table for field, table in data.items()})
+
+    def save_jsonl(self, path, shards=1):
+        """Save data to folder in sharded JSON lines format.
+
+        Args:
+            path: path to the folder.
+            shards: number of files to split users into.
+        """
+        with CommunityWriter(path, shards) as writer:
+            for user_id, user in self._users.items():
+                writer.write_user(
+                    user_id, user,
+                    self._user_attributes.get(user_id, {}),
+                    self._friends[user_id],
+                    self._subscriptions[user_id],
+                )
+            writer.write_tables(
+                self._groups, self._group_attributes,
+                self._cities, self._universities,
+            )
+
+    def memory_usage(self):
+        """Estimate memory occupied by community tables.
+
+        Containers shared between tables are counted once,
+        in the first table they appear in.
+
+        Takes time and memory proportional to the number of containers
+        in tables, e.g. seconds and tens of megabytes for hundreds
+        of thousands of users.
+
+        Returns:
+            Mapping from table names (e.g. 'users', 'friends') and 'total'
+            to dicts with number of 'entries' and size in 'bytes'.
+        """
+        seen = set()
+        result = {}
+        for field in self.fields:
+            table = self.__dict__[field]
+            result[field[1:]] = {
+                'entries': len(table),
+                'bytes': deep_getsizeof(table, seen),
+            }
+
+        result['total'] = {
+            key: sum(usage[key] for usage in result.values())
+            for key in ['entries', 'bytes']
+        }
+        return result
+
     def filter_users(self, predicate):
         """Get community containing all users that satisfy given predicate.
 
@@ -244,7 +336,7 @@ class Community(object):
         Returns:
             Sequence of Community.Group objects.
         """
-        for group_id in self._group:
+        for group_id in self._groups:
             yield self.get_group(group_id)
 
     def get_users(self):
@@ -256,6 +348,82 @@ class Community(object):
         for user_id in self._users:
             yield self.get_user(user_id)
             
+    def iter_users(self, fields):
+        """Get values of given fields for all users.
+
+        Faster than accessing attributes of Community.User objects
+        because no wrappers are created.
+
+        Args:
+            fields: list of names of user fields (e.g. 'age'),
+                user attributes (e.g. 'layer'), 'uid', 'friends' or 'groups'.
+                Missing attributes are replaced by None.
+
+        Returns:
+            Sequence of tuples of field values in the order of given fields.
+        """
+        if all(field in User._fields for field in fields):
+            indices = [User._fields.index(field) for field in fields]
+            for user in self._users.values():
+                yield tuple([user[index] for index in indices])
+            return
+
+        getters = [self._user_getter(field) for field in fields]
+        for user_id in self._users:
+            yield tuple([getter(user_id) for getter in getters])
+
+    def get_users_array(self, fields):
+        """Get numpy record array with values of given user fields.
+
+        Columns except 'uid' that contain only numbers and missing values
+        are converted to floats, missing values become NaN.
+
+        Args:
+            fields: see Community.iter_users, except 'friends' and 'groups'.
+
+        Returns:
+            numpy.recarray object.
+
+        Raises:
+            ValueError: if list-valued field is requested.
+        """
+        import numpy as np
+
+        for field in ['friends', 'groups']:
+            if field in fields:
+                raise ValueError('Field is list-valued: {}'.format(field))
+
+        rows = list(self.iter_users(fields))
+        columns = list(zip(*rows)) if rows else [()] * len(fields)
+
+        arrays = []
+        for field, column in zip(fields, columns):
+            if field != 'uid' and all(
+                value is None or isinstance(value, Number)
+                for value in column
+            ):
+                arrays.append(np.array(column, dtype=float))
+            else:
+                arrays.append(np.array(column))
+
+        return np.rec.fromarrays(arrays, names=fields)
+
+    def _user_getter(self, field):
+        """Get function from user id to value of given field."""
+        if field == 'uid':
+            return lambda user_id: user_id
+        elif field == 'friends':
+            return self._friends.__getitem__
+        elif field == 'groups':
+            return self._subscriptions.__getitem__
+        elif field in User._fields:
+            index = User._fields.index(field)
+            return lambda user_id: self._users[user_id][index]
+        else:
+            return lambda user_id: self._user_attributes.get(
+                user_id, {}
+            ).get(field)
+
     def get_user(self, uid):
         """Get user with given id.
 
@@ -286,9 +454,26 @@ class Community(object):
             For each pair of friends {u, v},
             there are entries (u, v) and (v, u).
         """
-        for user in self.get_users():
-            for friend in user.friends:
-                yield (user, friend)
+        return self._get_edgelist(self._get_user_wrappers())
+
+    def _get_user_wrappers(self):
+        """Get mapping from user ids to Community.User objects."""
+        return {user_id: self.get_user(user_id) for user_id in self._users}
+
+    def _get_edgelist(self, users):
+        """Get sequence of edges, reusing given wrappers.
+
+        Args:
+            users: mapping from user ids to Community.User objects.
+                Friends missing from it are skipped.
+        """
+        for user_id, friends in self._friends.items():
+            if user_id not in users:
+                continue
+            user = users[user_id]
+            for friend_id in friends:
+                if friend_id in users:
+                    yield (user, users[friend_id])
 
     def get_users_table(self):
         """Get pandas DataFrame with users.
@@ -296,6 +481,8 @@ class Community(object):
         Returns:
             DataFrame object.
         """
+        import pandas as pd
+
         return pd.DataFrame.from_items(
             items=(
                 (user.uid, (
@@ -316,30 +503,327 @@ class Community(object):
         Returns:
             networkx.Graph object.
         """
+        import networkx as nx
+
+        users = self._get_user_wrappers()
         g = nx.Graph()
-        g.add_nodes_from(self.get_users())
-        g.add_edges_from(self.get_edgelist())
+        g.add_nodes_from(users.values())
+        g.add_edges_from(self._get_edgelist(users))
 
         return g
 
-    def plot_geodata(self, embed=False):
+    def get_geodata(self, weight=None, bins=None, bin_size=1.0):
+        """Aggregate users by their location.
+
+        Args:
+            weight: name of numeric user field or attribute (e.g. 'age').
+                If given, its values are summed as is instead of counting
+                users, users without the value contribute nothing.
+            bins: None to aggregate by city, 'grid' to aggregate
+                into square cells or 'hex' to aggregate into hexagons.
+            bin_size: size of the cell in degrees.
+
+        Returns:
+            DataFrame with columns 'latitude', 'longitude' and 'count'.
+
+        Raises:
+            ValueError: if weight is unknown or not numeric.
+        """
+        import numpy as np
+        import pandas as pd
+
+        if weight is not None and weight not in User._fields and not any(
+            weight in attributes
+            for attributes in self._user_attributes.values()
+        ):
+            raise ValueError('Unknown user field: {}'.format(weight))
+
+        fields = ['city_id'] if weight is None else ['city_id', weight]
+        try:
+            values = np.array(
+                list(self.iter_users(fields)), dtype=float
+            ).reshape(-1, len(fields))
+        except (TypeError, ValueError):
+            raise ValueError('User field is not numeric: {}'.format(weight))
+
+        if weight is None:
+            weights = np.ones(len(values))
+        else:
+            weights = values[:, 1]
+
+        counts = pd.DataFrame({'city_id': values[:, 0], 'count': weights})
+        counts = counts.dropna(subset=['city_id'])
+        counts = counts.groupby(counts['city_id'].astype(int))['count'].sum()
+
+        cities = pd.DataFrame.from_dict(
+            {
+                city_id: city[1:]
+                for city_id, city in self._cities.items()
+                if not isinstance(city, str)
+            },
+            orient='index',
+            columns=['latitude', 'longitude'],
+            dtype=float,
+        )
+        data = cities.join(counts, how='inner').dropna()
+
+        if bins is None:
+            return data
+        elif bins == 'grid':
+            rows = np.floor(data['latitude'].values / bin_size)
+            cols = np.floor(data['longitude'].values / bin_size)
+            centers = (rows + 0.5) * bin_size, (cols + 0.5) * bin_size
+        elif bins == 'hex':
+            centers = _hex_centers(
+                data['latitude'].values, data['longitude'].values, bin_size
+            )
+        else:
+            raise ValueError('Unknown binning: {}'.format(bins))
+
+        data = pd.DataFrame({
+            'latitude': centers[0],
+            'longitude': centers[1],
+            'count': data['count'].values,
+        })
+        return data.groupby(
+            ['latitude', 'longitude'], as_index=False
+        )['count'].sum()
+
+    def plot_geodata(self, embed=False, weight=None, bins=None, bin_size=1.0,
+                     max_size=300):
         """Plot users on the map.
 
+        Marker areas grow as square root of counts,
+        so large cities do not cover the whole map.
+
         Args:
             embed: True if map should be drawn in IPython Notebook cell.
+            weight, bins, bin_size: see Community.get_geodata.
+            max_size: area of the largest marker in points^2.
         """
-        counter = Counter(u.city_id for u in self.get_users())
-        data = []
-        for city_id, count in counter.items():
-            if np.isnan(city_id):
-                continue
-            name, lat, lon = self._cities[city_id]
-            if (lat, lon) != (None, None):
-                data.append((lon, lat, count * 3))
-        xs, ys, sizes = list(zip(*data))
-        plt.scatter(xs, ys, s=sizes)
+        import numpy as np
+        import mplleaflet
+        from matplotlib import pyplot as plt
+
+        data = self.get_geodata(weight, bins, bin_size)
+        counts = data['count'].clip(lower=0).values
+        sizes = max_size * np.sqrt(counts / max(counts.max(), 1))
+        plt.scatter(data['longitude'], data['latitude'], s=sizes)
         if embed:
             return mplleaflet.display()
         else:
             return mplleaflet.show()
 
+
+class CommunityWriter(object):
+    """Streaming writer of community data in sharded JSON lines format.
+
+    Folder contains files users-00000.jsonl, users-00001.jsonl, ...
+    with one JSON record per user, and tables.json with groups,
+    group attributes, cities and universities.
+
+    User record is an object with user's fields (see utils.User), 'id',
+    'attributes', 'friends' and 'groups' keys.
+    """
+    def __init__(self, path, shards=1, mode='w'):
+        """Create new writer.
+
+        Args:
+            path: path to the folder.
+            shards: number of files to split users into.
+            mode: 'w' to remove previously saved data from the folder,
+                'a' to append to it (e.g. to resume a crawl).
+        """
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.mode = mode
+
+        if mode == 'w':
+            stale = glob(os.path.join(path, USERS_SHARD_PATTERN))
+            stale += glob(os.path.join(path, TABLES_FILE))
+            for stale_path in stale:
+                os.remove(stale_path)
+
+        self.files = [
+            open(os.path.join(path, USERS_SHARD.format(i)), mode,
+                 encoding='utf-8')
+            for i in range(shards)
+        ]
+
+    def write_user(self, uid, user, attributes, friends, subscriptions):
+        """Append user's record to its shard.
+
+        Args:
+            uid: user's id.
+            user: entry of users table.
+            attributes: dict of user's attributes.
+            friends: list of ids of user's friends.
+            subscriptions: list of ids of user's groups.
+        """
+        record = dict(zip(User._fields, user))
+        record.update(
+            id=uid,
+            attributes=attributes,
+            friends=friends,
+            groups=subscriptions,
+        )
+        shard = self.files[uid % len(self.files)]
+        shard.write(dumps(record, ensure_ascii=False) + '\n')
+
+    def write_tables(self, groups, group_attributes, cities, universities):
+        """Write side tables.
+
+        In 'a' mode new entries are merged into previously written tables,
+        otherwise previously written tables are replaced.
+        """
+        data = {
+            '_groups': groups,
+            '_group_attributes': group_attributes,
+            '_cities': cities,
+            '_universities': universities,
+        }
+        path = os.path.join(self.path, TABLES_FILE)
+
+        if self.mode == 'a' and os.path.exists(path):
+            with open(path, encoding='utf-8') as f:
+                tables = load(f)
+            for field, table in data.items():
+                merged = tables.get(field, {})
+                merged.update((str(k), v) for k, v in table.items())
+                data[field] = merged
+
+        with open(path, 'w', encoding='utf-8') as f:
+            dump(data, f, ensure_ascii=False)
+
+    def close(self):
+        for shard in self.files:
+            shard.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def _read_shard(args):
+    """Read user records satisfying predicate from shard.
+
+    Returns:
+        List of tuples (id, entry of users table, friends,
+        subscriptions, attributes), which are cheaper to send
+        between processes than records.
+    """
+    path, predicate = args
+    with open(path, encoding='utf-8') as f:
+        records = (loads(line) for line in f if line.strip())
+        return [
+            (
+                record['id'],
+                [record[field] for field in User._fields],
+                record['friends'],
+                record['groups'],
+                record['attributes'],
+            )
+            for record in records
+            if predicate is None or predicate(record)
+        ]
+
+
+def _load_jsonl(path, predicate=None, processes=None):
+    """Load tables from folder in sharded JSON lines format.
+
+    Args:
+        path: path to the folder.
+        predicate: function from user record to boolean.
+        processes: maximal number of processes to load shards with,
+            number of CPUs if None.
+
+    Returns:
+        Mapping from field names of Community to tables.
+    """
+    shards = sorted(glob(os.path.join(path, USERS_SHARD_PATTERN)))
+    tasks = [(shard, predicate) for shard in shards]
+
+    processes = min(processes or os.cpu_count() or 1, len(shards))
+    if processes <= 1:
+        chunks = map(_read_shard, tasks)
+    else:
+        from multiprocessing import Pool
+
+        with Pool(processes) as pool:
+            chunks = pool.map(_read_shard, tasks)
+
+    users, friends, subscriptions, user_attributes = {}, {}, {}, {}
+    for uid, user, friendlist, groups, attributes in chain(*chunks):
+        users[uid] = user
+        friends[uid] = friendlist
+        subscriptions[uid] = groups
+        user_attributes[uid] = attributes
+
+    if predicate is not None:
+        for user_id, friendlist in friends.items():
+            friends[user_id] = [
+                friend_id for friend_id in friendlist if friend_id in users
+            ]
+
+    members = {}
+    for user_id, groups in subscriptions.items():
+        for group_id in groups:
+            if group_id not in members:
+                members[group_id] = []
+            members[group_id].append(user_id)
+
+    tables_path = os.path.join(path, TABLES_FILE)
+    if os.path.exists(tables_path):
+        with open(tables_path, encoding='utf-8') as f:
+            tables = load(f)
+    else:
+        tables = {
+            '_groups': {}, '_group_attributes': {},
+            '_cities': {}, '_universities': {},
+        }
+
+    if predicate is not None:
+        for field in ['_groups', '_group_attributes']:
+            tables[field] = {
+                group_id: value
+                for group_id, value in tables[field].items()
+                if int(group_id) in members
+            }
+
+    tables.update(
+        _users=users,
+        _friends=friends,
+        _subscriptions=subscriptions,
+        _user_attributes=user_attributes,
+        _members=members,
+    )
+    return tables
+
+
+def _hex_centers(ys, xs, size):
+    """Snap points to centers of pointy-topped hexagonal grid.
+
+    Args:
+        ys, xs: numpy arrays of coordinates.
+        size: distance from center of hexagon to its corner.
+
+    Returns:
+        Pair of numpy arrays with coordinates of centers.
+    """
+    import numpy as np
+
+    q = (np.sqrt(3) / 3 * xs - ys / 3) / size
+    r = 2 / 3 * ys / size
+    s = -q - r
+
+    rq, rr, rs = np.round(q), np.round(r), np.round(s)
+    dq, dr, ds = np.abs(rq - q), np.abs(rr - r), np.abs(rs - s)
+
+    fix_q = (dq > dr) & (dq > ds)
+    fix_r = ~fix_q & (dr > ds)
+    rq = np.where(fix_q, -rr - rs, rq)
+    rr = np.where(fix_r, -rq - rs, rr)
+
+    return size * 3 / 2 * rr, size * np.sqrt(3) * (rq + rr / 2)
@@ -6,11 +6,17 @@ __author__ = 'Artur Chakhvadze (norpadon@yandex.ru)'
 
 import os
 import sys
+import json
+import shutil
+import tempfile
+import subprocess
 
 import unittest
+from tornado.concurrent import Future
 import vk_async.fetcher
 import vk_miner.community
 import vk_miner.algorithms
+import vk_miner.utils
 
 sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
 
@@ -24,8 +30,350 @@ USER_PASSWORD = ''
 from test_props import APP_IDS, USER_LOGIN, USER_PASSWORD, MY_ID, GROUP_ID
 
 
+def has_age(record):
+    return record['age'] is not None
+
+
+def resolved(value):
+    """Make future already resolved with given value."""
+    future = Future()
+    future.set_result(value)
+    return future
+
+
+class StubApi(object):
+    """Offline replacement of vk_async api.
+
+    User n has friends 10n and 10n + 1, all users are subscribed
+    to the same group, users with even ids study at the same university.
+    """
+    def __init__(self):
+        self.users = self
+        self.execute = self
+
+    @staticmethod
+    def entry(uid):
+        entry = {'id': uid, 'first_name': 'User', 'last_name': str(uid)}
+        if uid % 2 == 0:
+            entry['universities'] = [{'id': 5, 'name': 'MSU'}]
+        return entry
+
+    def get(self, user_ids, fields):
+        return resolved([self.entry(uid) for uid in user_ids])
+
+    def getUserData(self, user_id):
+        return resolved({
+            'friends': [self.entry(10 * user_id + i) for i in range(2)],
+            'groups': [{'id': 7, 'name': 'Group'}],
+        })
+
+
 class CommunityTestCase(unittest.TestCase):
-    pass
+    def setUp(self):
+        self.community = vk_miner.community.Community(
+            users={
+                1: ('Ivan Ivanov', 20, 1, None, ''),
+                2: ('Petr Petrov', 30, 1, None, ''),
+                3: ('Anna Ivanova', None, None, None, ''),
+                4: ('Olga Petrova', None, 2, None, ''),
+            },
+            groups={},
+            members={},
+            subscriptions={1: [], 2: [], 3: [], 4: []},
+            friends={1: [2], 2: [1], 3: [], 4: []},
+            user_attributes={
+                1: {'layer': 0}, 2: {'layer': 1},
+                3: {'layer': 1}, 4: {'layer': 1},
+            },
+            group_attributes={},
+            cities={
+                1: ['Moscow', 55.75, 37.62],
+                2: ['Saint Petersburg', 59.94, 30.31],
+            },
+            universities={},
+        )
+
+    def test_jsonl(self):
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        self.community.save_jsonl(path, shards=2)
+
+        for community in [
+            vk_miner.community.Community(path),
+            vk_miner.community.Community.load_jsonl(path, processes=2),
+        ]:
+            for field in self.community.fields:
+                self.assertEqual(
+                    getattr(community, field), getattr(self.community, field)
+                )
+
+        community = vk_miner.community.Community.load_jsonl(
+            path, predicate=has_age, processes=1
+        )
+        self.assertEqual(set(community._users), {1, 2})
+        self.assertEqual(community._friends, {1: [2], 2: [1]})
+
+    def test_jsonl_overwrite(self):
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        self.community.save_jsonl(path, shards=3)
+        self.community.filter_users(lambda u: u.uid == 1).save_jsonl(path)
+
+        community = vk_miner.community.Community(path)
+        self.assertEqual(set(community._users), {1})
+
+    def test_jsonl_append(self):
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        self.community.save_jsonl(path)
+
+        with vk_miner.community.CommunityWriter(path, mode='a') as writer:
+            writer.write_user(
+                5, ('Oleg Olegov', 25, 3, 4, ''), {'layer': 2}, [], [],
+            )
+            writer.write_tables(
+                {}, {}, {3: ['Kazan', 55.79, 49.12]}, {4: 'KFU'},
+            )
+
+        community = vk_miner.community.Community(path)
+        self.assertEqual(set(community._users), {1, 2, 3, 4, 5})
+        self.assertEqual(community.get_user(1).city, 'Moscow')
+        self.assertEqual(community.get_user(5).city, 'Kazan')
+        self.assertEqual(community.get_user(5).university, 'KFU')
+
+    def test_iter_users(self):
+        self.assertEqual(
+            list(self.community.iter_users(['age', 'city_id'])),
+            [(20, 1), (30, 1), (None, None), (None, 2)],
+        )
+        self.assertEqual(
+            list(self.community.iter_users(['uid', 'layer', 'friends'])),
+            [(1, 0, [2]), (2, 1, [1]), (3, 1, []), (4, 1, [])],
+        )
+
+        user = self.community.get_user(1)
+        self.assertEqual((user.age, user.layer, user.city), (20, 0, 'Moscow'))
+
+    def test_users_array(self):
+        array = self.community.get_users_array(
+            ['uid', 'age', 'city_id', 'layer', 'name']
+        )
+        self.assertEqual(array.dtype['uid'].kind, 'i')
+        for field in ['age', 'city_id', 'layer']:
+            self.assertEqual(array.dtype[field].kind, 'f')
+        self.assertEqual(array.dtype['name'].kind, 'U')
+        self.assertEqual(list(array.age[:2]), [20, 30])
+        self.assertTrue(all(array.age[2:] != array.age[2:]))  # NaN.
+
+        for field in ['friends', 'groups']:
+            with self.assertRaises(ValueError):
+                self.community.get_users_array(['uid', field])
+
+    def test_edgelist(self):
+        self.community._friends[3] = [42]
+        edges = list(self.community.get_edgelist())
+        self.assertEqual(
+            [(u.uid, v.uid) for u, v in edges], [(1, 2), (2, 1)]
+        )
+        self.assertIs(edges[0][0], edges[1][1])
+
+    def test_memory_usage(self):
+        usage = self.community.memory_usage()
+        self.assertEqual(usage['users']['entries'], 4)
+        self.assertEqual(usage['groups']['entries'], 0)
+        self.assertGreater(usage['friends']['bytes'], 0)
+        self.assertEqual(
+            usage['total']['bytes'],
+            sum(
+                usage[field[1:]]['bytes']
+                for field in self.community.fields
+            ),
+        )
+
+    def test_geodata(self):
+        data = self.community.get_geodata()
+        self.assertEqual(dict(data['count']), {1: 2, 2: 1})
+
+        data = self.community.get_geodata(weight='age')
+        self.assertEqual(dict(data['count']), {1: 50, 2: 0})
+
+        for weight in ['nonexistent', 'name', 'friends']:
+            with self.assertRaises(ValueError):
+                self.community.get_geodata(weight=weight)
+
+        for bins in ['grid', 'hex']:
+            data = self.community.get_geodata(bins=bins, bin_size=20)
+            self.assertEqual(list(data['count']), [3])
+
+
+class CrawlTestCase(unittest.TestCase):
+    def test_streaming(self):
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+
+        with vk_miner.community.CommunityWriter(path, shards=2) as writer:
+            community = vk_miner.algorithms.load_friends_bfs(
+                StubApi(), [1], 2, writer=writer
+            )
+        loaded = vk_miner.community.Community(path)
+
+        self.assertEqual(len(community._users), 7)
+        for field in community.fields:
+            if field == '_members':
+                continue
+            self.assertEqual(getattr(loaded, field), getattr(community, field))
+        self.assertEqual(
+            {k: sorted(v) for k, v in loaded._members.items()},
+            {k: sorted(v) for k, v in community._members.items()},
+        )
+
+    def test_interrupted_streaming(self):
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+
+        api = StubApi()
+        get_user_data = api.getUserData
+
+        def failing_get_user_data(user_id):
+            if user_id >= 20:
+                raise RuntimeError('Connection lost')
+            return get_user_data(user_id)
+
+        api.getUserData = failing_get_user_data
+
+        with vk_miner.community.CommunityWriter(path) as writer:
+            with self.assertRaises(RuntimeError):
+                vk_miner.algorithms.load_friends_bfs(
+                    api, [2], 2, writer=writer
+                )
+        loaded = vk_miner.community.Community(path)
+
+        self.assertEqual(set(loaded._users), {2})
+        self.assertEqual(loaded.get_user(2).university, 'MSU')
+        self.assertEqual(loaded.get_group(7).name, 'Group')
+
+    def test_profiling(self):
+        profiler = vk_miner.utils.CrawlProfiler(measure_memory=True)
+        community = vk_miner.algorithms.load_friends_bfs(
+            StubApi(), [1], 2, profiler=profiler
+        )
+        report = profiler.report()
+
+        sections = {section['name']: section for section in report['sections']}
+        self.assertEqual(
+            [section['name'] for section in report['sections']],
+            ['roots', 'layer 1', 'layer 2', 'geodata'],
+        )
+        for name in ['roots', 'layer 1', 'layer 2']:
+            self.assertGreater(sections[name]['rss'], 0)
+        for name in ['layer 1', 'layer 2']:
+            for metric in ['fetch', 'parse', 'tables']:
+                self.assertIn(metric, sections[name])
+        self.assertEqual(sections['roots']['users'], 1)
+        self.assertEqual(sections['layer 2']['users'], 2)
+        self.assertEqual(sections['layer 2']['new_users'], 4)
+        self.assertEqual(report['memory_usage'], community.memory_usage())
+
+
+class ProfilerTestCase(unittest.TestCase):
+    def test_report(self):
+        profiler = vk_miner.utils.CrawlProfiler()
+        profiler.add('first', 'users', 2)
+        profiler.add('first', 'users', 3)
+        with profiler.timer('second', 'fetch'):
+            pass
+        profiler.sample_rss('second')
+
+        report = profiler.report()
+        self.assertEqual(
+            set(report), {'sections', 'total_seconds', 'memory_usage'}
+        )
+        self.assertIsNone(report['memory_usage'])
+        self.assertGreaterEqual(report['total_seconds'], 0)
+
+        first, second = report['sections']
+        self.assertEqual(first, {'name': 'first', 'users': 5})
+        self.assertEqual(second['name'], 'second')
+        self.assertGreaterEqual(second['fetch'], 0)
+        self.assertGreater(second['rss'], 0)
+
+    def test_deep_getsizeof(self):
+        shared = [1, 2, 3]
+        size = vk_miner.utils.deep_getsizeof([shared, shared], set())
+        self.assertEqual(
+            size,
+            sys.getsizeof([shared, shared]) + sys.getsizeof(shared)
+            + 3 * sys.getsizeof(1),
+        )
+
+    def test_null_profiler(self):
+        profiler = vk_miner.utils.NullProfiler()
+        profiler.add('first', 'users', 1)
+        with profiler.timer('first', 'fetch'):
+            pass
+        profiler.sample_rss('first')
+
+
+class ImportBenchmarkTestCase(unittest.TestCase):
+    """Guard against heavy dependencies being imported eagerly."""
+    HEAVY_MODULES = [
+        'pandas', 'numpy', 'networkx', 'mplleaflet', 'matplotlib', 'geopy',
+    ]
+    # Generous limit, so loaded CI runners do not cause random failures.
+    MAX_IMPORT_TIME = 5.0  # Seconds.
+    MAX_IMPORT_RSS = 20 * 1024  # Kilobytes.
+
+    SCRIPT = '''
+import json
+import resource
+import sys
+import time
+
+# ru_maxrss is measured in bytes on macOS and in kilobytes elsewhere.
+scale = 1024 if sys.platform == 'darwin' else 1
+
+before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+start = time.perf_counter()
+if {module!r}:
+    __import__({module!r})
+elapsed = time.perf_counter() - start
+after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+print(json.dumps({{
+    'time': elapsed,
+    'rss': (after - before) // scale,
+    'modules': sorted(sys.modules),
+}}))
+'''
+
+    def measure_import(self, module):
+        """Import module in a fresh interpreter.
+
+        Args:
+            module: name of the module or empty string for no import.
+
+        Returns:
+            dict with import time in seconds, RSS growth in kilobytes
+            and list of loaded modules.
+        """
+        output = subprocess.check_output(
+            [sys.executable, '-c', self.SCRIPT.format(module=module)],
+            cwd=os.path.join(os.path.dirname(__file__), '..'),
+        )
+        return json.loads(output.decode())
+
+    def check_module(self, module):
+        report = self.measure_import(module)
+        loaded = {name.split('.')[0] for name in report['modules']}
+        for heavy in self.HEAVY_MODULES:
+            self.assertNotIn(heavy, loaded)
+        self.assertLess(report['time'], self.MAX_IMPORT_TIME)
+        self.assertLess(report['rss'], self.MAX_IMPORT_RSS)
+
+    def test_community_import(self):
+        self.check_module('vk_miner.community')
+
+    def test_algorithms_import(self):
+        self.check_module('vk_miner.algorithms')
 
 
 class VkMinerTestCase(unittest.TestCase):
@@ -4,11 +4,13 @@
 
 __author__ = 'Artur Chakhvadze (norpadon@yandex.ru)'
 
+import sys
+import time
 from collections import namedtuple
+from contextlib import contextmanager
 from itertools import *
 from datetime import datetime
 
-import geopy
 from tornado.ioloop import IOLoop
 from tornado import gen
 
@@ -25,6 +27,8 @@ def get_coordinates(city):
         (latitude, longitude) of city or (None, None) if city is unknown.
     """
     if city not in city_cache:
+        import geopy
+
         geocoder = geopy.geocoders.Yandex()
 
         try:
@@ -142,3 +146,125 @@ def grouper(iterable, n):
         filter(None.__ne__, pack)
         for pack in zip_longest(fillvalue=None, *args)
     ]
+
+
+CONTAINERS = (dict, list, tuple, set, frozenset)
+
+
+def deep_getsizeof(obj, seen):
+    """Compute size of object and all objects referenced by it.
+
+    Only containers are remembered in seen, so the overhead is
+    proportional to their number rather than to the number of scalars.
+    Scalars (numbers, strings, None) are counted at each reference,
+    which overestimates shared ones, e.g. small ints.
+
+    Args:
+        obj: dict, list, tuple, set or scalar object.
+        seen: set of ids of already counted containers, updated in place.
+
+    Returns:
+        Size in bytes.
+    """
+    if not isinstance(obj, CONTAINERS):
+        return sys.getsizeof(obj)
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+
+    size = sys.getsizeof(obj)
+    items = chain.from_iterable(obj.items()) if isinstance(obj, dict) else obj
+    for item in items:
+        if isinstance(item, CONTAINERS):
+            size += deep_getsizeof(item, seen)
+        else:
+            size += sys.getsizeof(item)
+
+    return size
+
+
+def get_rss():
+    """Get resident set size of current process in bytes.
+
+    Where /proc is not available (e.g. on macOS), peak RSS is returned
+    instead of the current one.
+    """
+    import resource
+
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * resource.getpagesize()
+    except OSError:
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # ru_maxrss is measured in bytes on macOS and in kilobytes elsewhere.
+        return rss if sys.platform == 'darwin' else rss * 1024
+
+
+class CrawlProfiler(object):
+    """Collects timings and memory samples of crawl phases.
+
+    Each section (e.g. 'roots', 'layer 1', 'geodata') accumulates
+    named metrics: durations in seconds, counts of entries
+    and RSS samples in bytes.
+    """
+    def __init__(self, measure_memory=False):
+        """Create new profiler.
+
+        Args:
+            measure_memory: True if memory usage of the resulting community
+                should be measured (see Community.memory_usage).
+                It takes seconds and tens of megabytes for
+                communities of hundreds of thousands of users.
+        """
+        self.sections = {}
+        self.measure_memory = measure_memory
+        self.memory_usage = None
+        self.start = time.perf_counter()
+
+    def add(self, section, metric, value):
+        """Add value to the metric of given section."""
+        stats = self.sections.setdefault(section, {})
+        stats[metric] = stats.get(metric, 0) + value
+
+    @contextmanager
+    def timer(self, section, metric):
+        """Add duration of the block to the metric of given section."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(section, metric, time.perf_counter() - start)
+
+    def sample_rss(self, section):
+        """Store current RSS in the given section."""
+        self.sections.setdefault(section, {})['rss'] = get_rss()
+
+    def report(self):
+        """Get collected data.
+
+        Returns:
+            dict with list of sections in order of their creation,
+            total time in seconds and memory usage of resulting community
+            (see Community.memory_usage) if it was measured.
+        """
+        return {
+            'sections': [
+                dict(stats, name=name)
+                for name, stats in self.sections.items()
+            ],
+            'total_seconds': time.perf_counter() - self.start,
+            'memory_usage': self.memory_usage,
+        }
+
+
+class NullProfiler(object):
+    """Profiler that collects nothing, used when profiling is disabled."""
+    def add(self, section, metric, value):
+        pass
+
+    @contextmanager
+    def timer(self, section, metric):
+        yield
+
+    def sample_rss(self, section):
+        pass